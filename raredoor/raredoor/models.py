@@ -1,37 +1,78 @@
+import binascii
+import hashlib
+import json
+import os
+import time
 import uuid
+from decimal import Decimal
 
 from django.conf import settings
 from django.contrib.auth.models import User as BaseUser
-from django.db import models
-from django.db.models import Q
+from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+from django.db.models import Prefetch, Q
 from django.utils import timezone
+from django.utils.six import StringIO
 from localflavor.us.models import PhoneNumberField
 
 from cloudinary.models import CloudinaryField
 
 
+def uuid7():
+    """Returns a time-ordered UUID (version 7).
+
+    Unlike uuid4, the leading 48 bits hold a millisecond unix timestamp,
+    so ids sort in creation order and INSERTs append to the right edge
+    of the primary key btree instead of hitting random leaf pages.
+    The remaining bits are random, same uniqueness guarantees as uuid4.
+    """
+    milliseconds = int(time.time() * 1000) & 0xffffffffffff
+    rand = int(binascii.hexlify(os.urandom(10)), 16)
+    value = milliseconds << 80
+    value |= 0x7 << 76                       # version 7
+    value |= (rand >> 62 & 0xfff) << 64      # 12 random bits
+    value |= 0x2 << 62                       # RFC 4122 variant
+    value |= rand & 0x3fffffffffffffff       # 62 random bits
+    return uuid.UUID(int=value)
+
+
+class MoneyField(models.BigIntegerField):
+    """Dollar amount stored as integer cents, e.g. 2000 is $20.00.
+
+    NUMERIC crosses the wire as a variable-width value and materializes
+    a decimal.Decimal per row in Python; int64 cents are fixed-width,
+    keep indexes small, and sum/compare as native integers in both
+    Postgres and Python. Convert with cents_to_dollars() at the
+    display edge only
+    """
+    description = 'Dollar amount stored as integer cents'
+
+
+def cents_to_dollars(cents):
+    """Converts stored integer cents into a Decimal dollar amount"""
+    if cents is None:
+        return None
+    return Decimal(cents) / 100
+
+
 # ----------------------------------------------------
 # Mixins
 # ----------------------------------------------------
 class UUIDModel(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
 
     class Meta:
         abstract = True
 
 
 class TimestampedModel(models.Model):
-    created_at = models.DateTimeField(blank=False, null=False)
-    updated_at = models.DateTimeField(blank=False, null=False)
-
-    def save(self, *args, **kwargs):
-        """Sets/updates created_at and updated_at timestamps"""
-
-        right_now = timezone.now()
-        if(not self.id):
-            self.created_at = right_now
-        self.updated_at = right_now
-        super(TimestampedModel, self).save(*args, **kwargs)
+    # auto_now_add/auto_now are applied at the field level (pre_save),
+    # so bulk_create/bulk paths get correct timestamps too - an explicit
+    # save() override would be skipped by those
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         abstract = True
@@ -44,10 +85,72 @@ class AbstractImageModel(models.Model):
     #main image will be primary/1st displayed to user
     is_main = models.BooleanField(default=False)
     image = CloudinaryField('image')
-    
+    # fully-resolved delivery URL, persisted on save so list pages read
+    # a plain column instead of rebuilding (and signing) the Cloudinary
+    # URL in Python for every row
+    image_url = models.URLField(max_length=500, blank=True, default='', editable=False)
+
+    def __init__(self, *args, **kwargs):
+        super(AbstractImageModel, self).__init__(*args, **kwargs)
+        # snapshot so save() can tell whether the image was replaced.
+        # Read through __dict__, not the attribute: when the row was
+        # loaded with only()/defer() the descriptor would fire an extra
+        # SELECT per instance just to take this snapshot
+        self._loaded_image = self.__dict__.get('image')
+
+    def save(self, *args, **kwargs):
+        """Refreshes image_url whenever the underlying image changes"""
+
+        if self.image and (not self.image_url or self.image != self._loaded_image):
+            self.image_url = self.image.build_url(secure=True)
+        elif not self.image:
+            self.image_url = ''
+        super(AbstractImageModel, self).save(*args, **kwargs)
+        self._loaded_image = self.__dict__.get('image')
+
+    class Meta:
+        abstract = True
+
+
+class CachedLookupModel(models.Model):
+    """Mixin for the small, near-immutable lookup tables
+    (Style, Category, Color, ...).
+
+    These are hit on every product serialization but change about never,
+    so the whole table is kept in the cache and only re-read from the
+    database after a write
+    """
+
+    CACHE_TIMEOUT = 24 * 60 * 60  # rows barely change, a day is fine
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def _cache_key(cls):
+        return 'lookup:%s:all' % cls.__name__.lower()
+
+    @classmethod
+    def all_cached(cls):
+        """Returns {pk: instance} for the whole table, from cache when warm"""
+        rows = cache.get(cls._cache_key())
+        if rows is None:
+            rows = dict((row.pk, row) for row in cls.objects.all())
+            cache.set(cls._cache_key(), rows, cls.CACHE_TIMEOUT)
+        return rows
+
+    @classmethod
+    def invalidate_cached(cls):
+        cache.delete(cls._cache_key())
+
+    def save(self, *args, **kwargs):
+        super(CachedLookupModel, self).save(*args, **kwargs)
+        self.invalidate_cached()
+
+    def delete(self, *args, **kwargs):
+        super(CachedLookupModel, self).delete(*args, **kwargs)
+        self.invalidate_cached()
+
 
 class Merchant(UUIDModel):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, limit_choices_to=Q(profile__is_merchant=True), null=True, blank=True)
@@ -63,9 +166,14 @@ class Merchant(UUIDModel):
 # Choices
 # ----------------------------------------------------
 class DiscountType(object):
-    """This class maintains a list of all Discount types"""
-    RETAILER_SPECIFIC = 'RETAILER_SPECIFIC'
-    GENERAL = 'GENERAL'
+    """This class maintains a list of all Discount types.
+
+    Stored as small integers rather than strings: the db_index on
+    discount_type stays 2 bytes per entry instead of the up-to-50-char
+    varchar, and filter predicates become integer comparisons
+    """
+    RETAILER_SPECIFIC = 1
+    GENERAL = 2
 
 DISCOUNT_TYPES = (
     (DiscountType.RETAILER_SPECIFIC, 'Retailer-specific promo'),
@@ -83,7 +191,16 @@ class User(UUIDModel, BaseUser):
     goint to be used anywhere. The value of username
     will be email hash to guarantee that it is always unique
     """
-    pass
+
+    def save(self, *args, **kwargs):
+        """Sets username to the md5 hash of the lower-cased email.
+
+        Truncated to 30 chars to fit the stock username column; 120 bits
+        of digest is still far more than enough to never collide, and the
+        unique index on username keeps guarding it either way.
+        """
+        self.username = hashlib.md5(self.email.strip().lower().encode('utf-8')).hexdigest()[:30]
+        super(User, self).save(*args, **kwargs)
 
 
 class PostalAddress(UUIDModel, TimestampedModel):
@@ -91,7 +208,10 @@ class PostalAddress(UUIDModel, TimestampedModel):
     street2 = models.CharField(max_length=50, null=True, blank=True)
     city = models.CharField(max_length=20)
     state = models.CharField(max_length=2)  # TODO: needs list of choices here
-    zipcd = models.IntegerField()
+    # stored as text, not an integer: New England ZIPs have leading
+    # zeros and ZIP+4 has a dash, so an int needs re-formatting in
+    # Python on every read
+    zipcd = models.CharField(max_length=10)
     lat = models.FloatField(null=True, blank=True)
     lng = models.FloatField(null=True, blank=True)
     neighborhood = models.CharField(max_length=80)  # TODO: needs list of choices here
@@ -108,14 +228,53 @@ class Profile(models.Model):
 
     user = models.OneToOneField(settings.AUTH_USER_MODEL, blank=False, null=False, related_name='profile')
     is_merchant = models.BooleanField(blank=False, null=False, default=False)
-    account_balance = models.DecimalField(help_text="Positive value means credit to the user, negative means user ows to us")
+    account_balance = MoneyField(blank=False, null=False, default=0, help_text="In cents. Positive value means credit to the user, negative means user ows to us")
     shipping_address = models.ForeignKey(PostalAddress, blank=True, null=True, default=True)
     contact_info = models.ForeignKey(ContactInfo, blank=True, null=True, default=True)
 
 
+class RetailerQuerySet(models.QuerySet):
+
+    def with_display(self):
+        """Bundles the joins/prefetches every retailer render needs
+        so callers can't forget them and fall back into N+1 queries
+        """
+        return self.select_related('address').prefetch_related('images', 'stores')
+
+    def with_detail(self):
+        """Everything the retailer detail page renders, in a fixed
+        number of queries.
+
+        Logos land on retailer.logos via to_attr so templates can read
+        retailer.logos[0] without firing another SELECT; the image
+        only() keeps the retailer FK column so Django can stitch the
+        prefetch results back onto their retailers. M2M-ish relations
+        stay in prefetch_related - joining them would explode rows
+        """
+        return self.select_related('address', 'owner').prefetch_related(
+            Prefetch('images',
+                     queryset=RetailerImage.objects.filter(is_logo=True).only(
+                         'id', 'retailer', 'image_url', 'is_main', 'is_logo'),
+                     to_attr='logos'),
+            'images', 'stores', 'discounts',
+        )
+
+
 class Retailer(Merchant):
     legal_name = models.CharField(max_length=255)
     short_name = models.CharField(max_length=100)
+    # lower-cased shadow of short_name kept in sync by save(). The
+    # unique index on it gives case-insensitive uniqueness and lets
+    # lookups use filter(short_name_key=value.lower()) - an O(log n)
+    # index hit, where short_name__iexact would be a seq scan
+    short_name_key = models.CharField(max_length=100, unique=True, editable=False)
+
+    objects = RetailerQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        """Keeps the lower-cased short_name shadow column in sync"""
+        self.short_name_key = self.short_name.strip().lower()
+        super(Retailer, self).save(*args, **kwargs)
 
 
 class RetailerImage(AbstractImageModel):
@@ -127,19 +286,19 @@ class Store(Merchant):
     retailer = models.ForeignKey(Retailer, related_name='stores')
     has_returns = models.BooleanField(default=False)
     commission_fee = models.DecimalField(blank=False, null=False, max_digits=8, decimal_places=2)
-    transaction_fee = models.DecimalField(blank=False, null=False, max_digits=8, decimal_places=2)
+    transaction_fee = MoneyField(blank=False, null=False, default=0)
     order_prefix = models.CharField(max_length=4, unique=True, blank=False, null=False, help_text='This will be pre-pended to all orders from this retailer')
 
 
 class Discount(models.Model):
     
     name = models.CharField(max_length=100, blank=False, null=False, help_text='e.g. Get $10 off your $50 order')
-    short_terms = models.TextField(max_length=1000, blank=True, null=False, defult='', help_text='This is a short vertion of the terms that we can show to the user e.g. on a front page where they might actually read it.')
+    short_terms = models.TextField(max_length=1000, blank=True, null=False, default='', help_text='This is a short vertion of the terms that we can show to the user e.g. on a front page where they might actually read it.')
     terms = models.TextField(max_length=10000, blank=True, null=False, default='', help_text='This is the "fine print", explaining in every details the terms of the promotion')
 
     # having a special field would allow us to figure out
     # how each 'kind' of offer should be handled
-    discount_type = models.CharField(max_length=50, choices=DISCOUNT_TYPES, blank=False, null=False, db_index=True, help_text='This field determines how offer is applied: e.g. Retailer-specific discounts are only for the goods sold by that retailer')
+    discount_type = models.PositiveSmallIntegerField(choices=DISCOUNT_TYPES, blank=False, null=False, db_index=True, help_text='This field determines how offer is applied: e.g. Retailer-specific discounts are only for the goods sold by that retailer')
     retailer = models.ForeignKey(Retailer, blank=True, null=True, default=None, related_name='discounts')
 
     # The following fields are used to determine whether or not this discount is valid. The most imporant one
@@ -158,36 +317,73 @@ class Discount(models.Model):
     # the way one would expect. I've ran into this long time ago,
     # but the issue still remains to this day see my stackoverflow question for details
     # http://stackoverflow.com/questions/454436/unique-fields-that-allow-nulls-in-django
+    # save() also lower-cases the code, so lookups must use
+    # filter(code=value.lower()) - plain '=' uses the btree index,
+    # iexact/ILIKE can't
     code = models.CharField(max_length=100, blank=True, default='', db_index=True, help_text='Code for the promotion. Codes are case insensitive, e.g. PROMO2015 and Promo2015 is the same thing, so cannot create two different codes like that.')
 
     # The following fields determine the actual value of the discount
     # Either fixed_amount_off or percent_off must be set and be non-zero
     # we will handle this constraint in the save() method
-    fixed_amount_off = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True, default=None, help_text='e.g. 20 means $20 off')
-    fixed_amount_off_minimum_order = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True, default=None, help_text='Order minimum that is required (if any) to get this discount. 0 means there is not minimum. This is applicable only when fixed_amount_off is set')
+    fixed_amount_off = MoneyField(blank=True, null=True, default=None, help_text='In cents, e.g. 2000 means $20 off')
+    fixed_amount_off_minimum_order = MoneyField(blank=True, null=True, default=None, help_text='Order minimum in cents that is required (if any) to get this discount. 0 means there is not minimum. This is applicable only when fixed_amount_off is set')
     percent_off = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True, default=None, help_text='Expressed as percentage, e.g. 10 means 10% off')
-    percent_off_limit = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True, default=None, help_text='Limits the maximum dollar value of the Percent discount off. This is applicable only when percent_off is set')
+    percent_off_limit = MoneyField(blank=True, null=True, default=None, help_text='Limits the maximum value (in cents) of the Percent discount off. This is applicable only when percent_off is set')
+
+    def save(self, *args, **kwargs):
+        """Normalizes the code and enforces the 'unique unless empty' rule.
+
+        Codes are stored already lower-cased so redemption lookups can use
+        plain equality against the indexed column instead of iexact, which
+        would force a sequential scan.
+        """
+        self.code = (self.code or '').strip().lower()
+        if self.code and Discount.objects.filter(code=self.code).exclude(pk=self.pk).exists():
+            raise ValidationError({'code': 'A discount with this code already exists'})
+        super(Discount, self).save(*args, **kwargs)
+
+    class Meta:
+        # code redemption checks both the code and the on/off switch
+        index_together = [
+            ['code', 'is_active'],
+        ]
 
 
-def generate_order_number(order):
+class OrderNumberSequence(models.Model):
+    """Per-store counter backing generate_order_number.
+
+    A dedicated row per store hands out numbers under a row lock, so
+    concurrent checkouts don't serialize on (or deadlock around) a
+    SELECT MAX(order_number) over the whole orders table
+    """
+    store = models.OneToOneField(Store, blank=False, null=False, related_name='order_sequence')
+    next_number = models.PositiveIntegerField(blank=False, null=False, default=1)
+
+
+def generate_order_number(store):
     """Generates new order number in the following format:
-    
+
     <RETAILER PREFIX><NUMERIC PART>
-    
-    RETAILER PREFIX - string containing letters, comes from order.product.retailer.order_prefix
-    NUMERIC PART - number that along with retailer prefix makes the order unique
+
+    RETAILER PREFIX - string containing letters, comes from store.order_prefix
+    NUMERIC PART - zero-padded counter that along with retailer prefix makes the order unique
     """
-    pass
+    with transaction.atomic():
+        sequence, _ = OrderNumberSequence.objects.select_for_update().get_or_create(store=store)
+        number = sequence.next_number
+        sequence.next_number = number + 1
+        sequence.save()
+    return '%s%08d' % (store.order_prefix, number)
 
 
 class BaseOrder(TimestampedModel):
     """Contains the fields that are same between Order and Offer"""
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=False, null=False, related_name='user_orders')
     shipping_address = models.ForeignKey(PostalAddress)
-    subtotal = models.DecimalField(max_digits=8, decimal_places=2, default=0.00, help_text='Total price of all items before discounts, shipping  and taxes')
-    taxes = models.DecimalField(max_digits=8, decimal_places=2, blank=None, null=None, default=0.00, help_text="Taxes in dollars")
-    shipping_price = models.DecimalField(max_digits=8, decimal_places=2, blank=None, null=None, default=0.00, help_text="Price of shipping")
-    total_transaction_price = models.DecimalField(max_digits=8, decimal_places=2, default=0.00, help_text='Total purchase price the user paid including promotions and taxes')
+    subtotal = MoneyField(default=0, help_text='Total price in cents of all items before discounts, shipping  and taxes')
+    taxes = MoneyField(blank=False, null=False, default=0, help_text="Taxes in cents")
+    shipping_price = MoneyField(blank=False, null=False, default=0, help_text="Price of shipping in cents")
+    total_transaction_price = MoneyField(default=0, help_text='Total purchase price in cents the user paid including promotions and taxes')
 
     class Meta:
         abstract = True
@@ -198,14 +394,94 @@ class BaseOrderItem(TimestampedModel):
     product_variation = models.ForeignKey('ProductVariation', blank=False, null=False, related_name="product_variation_%(class)s")
     store = models.ForeignKey(Store, blank=False, null=False, related_name="store_%(class)s")
     quantity = models.PositiveIntegerField(blank=False, null=False)
-    purchase_price = models.DecimalField(max_digits=8, decimal_places=2, default=0.00, help_text='Price of the product before taxes and discounts')
+    purchase_price = MoneyField(default=0, help_text='Price of the product in cents before taxes and discounts')
 
     class Meta:
         abstract = True
 
 
+class OrderQuerySet(models.QuerySet):
+
+    def with_display(self):
+        """Bundles the joins/prefetches every order render needs
+        so callers can't forget them and fall back into N+1 queries
+        """
+        return self.select_related('user', 'shipping_address').prefetch_related(
+            'items__product_variation__product',
+        )
+
+
 class Order(BaseOrder):
-    order_number = models.CharField(primary_key=True, max_lendth=20, blank=False, null=False, default=generate_order_number, editable=False)
+    # set by the checkout path via generate_order_number(store) - a
+    # plain default callable can't be used because the number depends
+    # on which store the order is for
+    order_number = models.CharField(primary_key=True, max_length=20, blank=False, null=False, editable=False)
+    # denormalized copy of the store's order_prefix so reporting can
+    # group by retailer without the OrderItem -> Store join
+    order_prefix = models.CharField(max_length=4, blank=True, default='', editable=False)
+    # JSON snapshot of the finished order (items, address, discounts)
+    # written once at checkout; order-history pages read this single
+    # column instead of joining items/products/addresses per order
+    completed_snapshot = models.TextField(blank=True, null=True, default=None, editable=False)
+
+    objects = OrderQuerySet.as_manager()
+
+    def take_snapshot(self):
+        """Freezes the order's items, address and discounts into
+        completed_snapshot.
+
+        Completed orders never change again, so the history page can
+        render from this one column with zero joins and no N+1; the
+        normalized OrderItem rows stay around for analytics
+        """
+        items = []
+        for item in self.items.select_related('product_variation__product'):
+            items.append({
+                'product': item.product_variation.product.short_name,
+                'variation': item.product_variation.variation_name,
+                'sku': item.product_variation.variation_sku,
+                'quantity': item.quantity,
+                'purchase_price': item.purchase_price,
+            })
+        address = self.shipping_address
+        self.completed_snapshot = json.dumps({
+            'items': items,
+            'address': {
+                'street': address.street,
+                'street2': address.street2,
+                'city': address.city,
+                'state': address.state,
+                'zipcd': address.zipcd,
+            },
+            'discounts': [
+                {'discount_id': redemption.discount_id,
+                 'discount_amount': redemption.discount_amount}
+                for redemption in self.order_discount_redemptions.all()
+            ],
+        })
+
+    @property
+    def snapshot(self):
+        """The parsed snapshot, or None while the order is still open"""
+        return json.loads(self.completed_snapshot) if self.completed_snapshot else None
+
+    def save(self, *args, **kwargs):
+        """Captures the retailer prefix off the generated order number.
+
+        The prefix is all letters and the counter all digits (see
+        generate_order_number), so strip trailing digits rather than
+        slicing a fixed width - '%08d' widens past 8 digits once a
+        store's counter outgrows it
+        """
+        if self.order_number and not self.order_prefix:
+            self.order_prefix = self.order_number.rstrip('0123456789')
+        super(Order, self).save(*args, **kwargs)
+
+    class Meta:
+        # "my orders" pages filter by user and sort by date
+        index_together = [
+            ['user', 'created_at'],
+        ]
 
 
 class OrderItem(BaseOrderItem):
@@ -214,7 +490,14 @@ class OrderItem(BaseOrderItem):
 
 class Offer(BaseOrderItem, BaseOrder):
     is_active = models.BooleanField(default=True)
-    expiration_timestamp = models.DateTimeField(blank=False, null=False, help_text='When this offer expires')
+    expiration_timestamp = models.DateTimeField(blank=False, null=False, db_index=True, help_text='When this offer expires')
+
+    class Meta:
+        # offers accumulate forever but only active, unexpired ones are
+        # read; the composite index lets that scan skip the dead rows
+        index_together = [
+            ['is_active', 'expiration_timestamp'],
+        ]
 
 
 class Cart(models.Model):
@@ -230,22 +513,22 @@ class DiscountRedemption(models.Model):
     discount = models.ForeignKey(Discount, blank=False, null=False, related_name='discount_redemptions')
     order = models.ForeignKey(Order, blank=False, null=False, related_name='order_discount_redemptions')
     timestamp = models.DateTimeField(blank=False, null=False, help_text='When this was redeemed')
-    total_before_discount = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True, default=None, help_text="Total dollar amount before applying any promotinal discounts to the order")
-    discount_amount = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True, default=None, help_text="Discount dollar amount")
+    total_before_discount = MoneyField(blank=True, null=True, default=None, help_text="Total amount in cents before applying any promotinal discounts to the order")
+    discount_amount = MoneyField(blank=True, null=True, default=None, help_text="Discount amount in cents")
 
 
 # ----------------------------------------------------
 # Product-related models
 # ----------------------------------------------------
-class Style(models.Model):
+class Style(CachedLookupModel):
     select = models.CharField(unique=True, max_length=55, default='modern', null=True, blank=True)
 
 
-class Category(models.Model):
+class Category(CachedLookupModel):
     select = models.CharField(unique=True, max_length=55, default='living', null=True, blank=True)
 
 
-class Subcategory(models.Model):
+class Subcategory(CachedLookupModel):
     category = models.ForeignKey(Category, blank=False, null=False)
     select = models.CharField(unique=True, max_length=55, default='bar', null=True, blank=True)
 
@@ -254,7 +537,7 @@ class Subcategory(models.Model):
     # for chairs that would be seat height, etc.
     features = models.ManyToManyField('Feature', blank=True, null=True, related_name='subcategories')
 
-class PieceType(models.Model):
+class PieceType(CachedLookupModel):
     subcategory = models.ForeignKey(Subcategory, blank=False, null=False)
     select = models.CharField(unique=True, max_length=55, default='', null=True, blank=True)
     # features are product properties that are specific for a particular type
@@ -263,14 +546,14 @@ class PieceType(models.Model):
     features = models.ManyToManyField('Feature', blank=True, null=True, related_name='piece_types')
 
 
-class Color(models.Model):
+class Color(CachedLookupModel):
     select = models.CharField(unique=True, max_length=55, default='blue', null=True, blank=True)
 
-class Material(models.Model):
+class Material(CachedLookupModel):
     select = models.CharField(unique=True, max_length=55, default='leather', null=True, blank=True)
 
 
-class DeliverySize(models.Model):
+class DeliverySize(CachedLookupModel):
     select = models.CharField(unique=True, max_length=55, default='', null=True, blank=True)
 
 
@@ -281,9 +564,9 @@ class Manufacturer(models.Model):
 class ProductVariationStore(models.Model):
     product_variation = models.ForeignKey('ProductVariation', blank=False, null=False)
     store = models.ForeignKey(Store, blank=False, null=False)
-    original_price = models.DecimalField(max_digits=8, decimal_places=2, default=0.00)
-    current_price = models.DecimalField(max_digits=8, decimal_places=2, default=0.00)
-    minimum_offer_price = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True, default=None)
+    original_price = MoneyField(default=0)
+    current_price = MoneyField(default=0)
+    minimum_offer_price = MoneyField(null=True, blank=True, default=None)
     url = models.URLField(null=True, blank=True, max_length=255)
     is_available = models.BooleanField(blank=False, null=False)
 
@@ -318,9 +601,88 @@ class ProductVariationImage(AbstractImageModel):
     product_variation = models.ForeignKey(ProductVariation, related_name='images')
 
 
+def _copy_literal(value):
+    """Renders a Python value in Postgres COPY text format"""
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (list, tuple)):  # e.g. the tags ArrayField
+        # quote each element for array-literal syntax (backslashes and
+        # double quotes escaped), then fall through so the assembled
+        # {...} gets the same COPY control-character escaping as any
+        # other value - otherwise a tag with a tab/newline/backslash
+        # shifts columns and corrupts the whole stream
+        elements = []
+        for element in value:
+            if element is None:
+                elements.append('NULL')
+            else:
+                element = u'%s' % element
+                elements.append('"%s"' % element.replace('\\', '\\\\').replace('"', '\\"'))
+        value = '{%s}' % ','.join(elements)
+    else:
+        value = u'%s' % value
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_rows(table, columns, rows):
+    """Streams rows into a table with COPY FROM STDIN - one round-trip
+    per batch instead of one INSERT statement per row
+    """
+    buf = StringIO()
+    for row in rows:
+        buf.write('\t'.join(_copy_literal(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    with connection.cursor() as cursor:
+        cursor.copy_from(buf, table, columns=columns)
+
+
+class ProductQuerySet(models.QuerySet):
+
+    def with_display(self):
+        """Bundles the joins/prefetches every product render needs
+        so callers can't forget them and fall back into N+1 queries.
+        M2Ms go through prefetch_related (a second query each) instead
+        of select_related so we don't explode the row count with joins
+        """
+        return self.select_related('manufacturer', 'retailer', 'stats',
+                                   'category', 'piece_type', 'delivery_size').prefetch_related(
+            'style', 'subcategory',
+            Prefetch('variations', queryset=ProductVariation.objects.prefetch_related(
+                'color', 'material', 'images', 'stores')),
+        )
+
+    def card_fields(self):
+        """Trims the SELECT down to the columns product card templates use.
+
+        The default SELECT drags description and the other wide TEXT
+        columns along for every row of a 60-card grid; only()-ing the
+        card columns skips fetching (and detoasting) all of that. The
+        retailer FK column stays in the list so prefetches/joins can
+        still stitch rows together
+        """
+        return self.only(
+            'id', 'slug', 'short_name', 'msrp', 'retailer',
+            'is_sold', 'is_published', 'pub_date',
+        ).prefetch_related(
+            Prefetch('variations', queryset=ProductVariation.objects.filter(is_default=True).only(
+                'id', 'product', 'variation_name').prefetch_related(
+                    Prefetch('images', queryset=ProductVariationImage.objects.filter(is_main=True).only(
+                        'id', 'product_variation', 'image_url')))),
+        )
+
+
 class Product(UUIDModel, TimestampedModel):
 
     manufacturer = models.ForeignKey(Manufacturer, blank=True, null=True)
+    # denormalized from the selling store so order handling and retailer
+    # pages reach the retailer in one hop instead of going through
+    # variations -> stores -> retailer
+    retailer = models.ForeignKey(Retailer, blank=True, null=True, default=None, related_name='products')
     manufacturer_sku = models.CharField(max_length=100, null=True, blank=True)
     upc = models.CharField(max_length=12, null=True, blank=True)
 
@@ -328,21 +690,28 @@ class Product(UUIDModel, TimestampedModel):
     slug = models.SlugField(unique=True, max_length=255)
     description = models.TextField(null=True, blank=True)
 
-    msrp = models.DecimalField(max_digits=8, decimal_places=2, default=0.00)
+    msrp = MoneyField(default=0)
 
     weight = models.DecimalField(max_digits=5, decimal_places=1, null=True, blank=True)
-    tags = models.TextField(null=True, blank=True)  # list of tag words
+    # list of tag words; a real array instead of a text blob so tag
+    # filters use tags__contains=['word'] (the @> operator, indexable
+    # with GIN) instead of icontains seq scans + Python split() on read
+    tags = ArrayField(models.CharField(max_length=40), default=list, blank=True)
     is_custom = models.BooleanField(default=False)
     is_floor_model = models.BooleanField(default=False)
     is_vintage = models.BooleanField(blank=False, null=False)
     is_hand_made = models.BooleanField(blank=False, null=False)
 
-    # Categorization
+    # Categorization. category/piece_type/delivery_size are plain FKs -
+    # a product belongs to exactly one of each, and an FK joins via
+    # select_related instead of costing a through-table prefetch query
+    # per field per request. style and subcategory are genuinely
+    # multi-valued and stay M2M
     style = models.ManyToManyField(Style, null=True, blank=True, verbose_name='style')
-    category = models.ManyToManyField(Category, null=True, blank=True)
+    category = models.ForeignKey(Category, on_delete=models.PROTECT, null=True, blank=True)
     subcategory = models.ManyToManyField(Subcategory, null=True, blank=True)
-    piece_type = models.ManyToManyField(PieceType, null=True, blank=True)
-    delivery_size = models.ManyToManyField(DeliverySize, null=True, blank=True)
+    piece_type = models.ForeignKey(PieceType, on_delete=models.PROTECT, null=True, blank=True)
+    delivery_size = models.ForeignKey(DeliverySize, on_delete=models.PROTECT, null=True, blank=True)
 
     # Availability
     added_date = models.DateTimeField(auto_now_add=True)
@@ -352,6 +721,152 @@ class Product(UUIDModel, TimestampedModel):
     is_published = models.BooleanField(default=False)
     is_featured = models.BooleanField(default=False)
     is_recent = models.BooleanField(default=True)
-    hours_left = models.IntegerField(default=settings.SHELF_LIFE, null=True, blank=True)
+
+    objects = ProductQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        """Creates the companion ProductStats row for new products"""
+        is_new = self._state.adding
+        super(Product, self).save(*args, **kwargs)
+        if is_new:
+            ProductStats.objects.get_or_create(product=self)
+
+    # M2M fields bulk_ingest accepts as lists of related pks; the
+    # single-valued dimensions (category etc.) are FKs and come through
+    # the regular column list
+    INGEST_M2M_FIELDS = ('style', 'subcategory')
+
+    @classmethod
+    def bulk_ingest(cls, rows):
+        """Bulk-loads a retailer catalog dump.
+
+        rows is an iterable of dicts keyed by field name; the M2M fields
+        in INGEST_M2M_FIELDS take lists of related pks. The product table
+        and each m2m through table are loaded with COPY, which skips the
+        per-row ORM machinery entirely - for catalogs in the tens of
+        thousands of rows this is orders of magnitude faster than a
+        save() loop or even bulk_create. Returns the assigned product ids.
+        """
+        concrete_fields = cls._meta.concrete_fields
+        right_now = timezone.now()
+        product_rows = []
+        m2m_rows = dict((name, []) for name in cls.INGEST_M2M_FIELDS)
+        ids = []
+        for row in rows:
+            pk = row.get('id') or uuid7()
+            ids.append(pk)
+            values = []
+            for field in concrete_fields:
+                if field.primary_key:
+                    values.append(pk)
+                elif field.name in ('created_at', 'updated_at', 'added_date'):
+                    values.append(right_now)
+                elif field.attname in row:
+                    values.append(row[field.attname])
+                elif field.name in row:
+                    values.append(row[field.name])
+                else:
+                    values.append(field.get_default())
+            product_rows.append(values)
+            for name in cls.INGEST_M2M_FIELDS:
+                for related_pk in row.get(name, ()):
+                    m2m_rows[name].append((pk, related_pk))
+        with transaction.atomic():
+            _copy_rows(cls._meta.db_table, [field.column for field in concrete_fields], product_rows)
+            # companion stats rows, normally created by Product.save(),
+            # which the COPY path bypasses
+            _copy_rows(ProductStats._meta.db_table,
+                       ('product_id', 'click_count', 'display_score', 'hours_left'),
+                       [(pk, 0, 0, settings.SHELF_LIFE) for pk in ids])
+            for name in cls.INGEST_M2M_FIELDS:
+                if not m2m_rows[name]:
+                    continue
+                field = cls._meta.get_field(name)
+                _copy_rows(field.rel.through._meta.db_table,
+                           (field.m2m_column_name(), field.m2m_reverse_name()),
+                           m2m_rows[name])
+        return ids
+
+    class Meta:
+        # Composite indexes matching the feed/listing predicates
+        # (published+unsold by date, and the "what's new" listing) so
+        # those queries don't fall back to full table scans
+        index_together = [
+            ['is_published', 'is_sold', 'pub_date'],
+            ['is_featured', 'is_published', 'pub_date'],
+        ]
+
+
+class ProductStats(models.Model):
+    """High-write counters split off Product.
+
+    Every UPDATE rewrites the whole row under Postgres MVCC, so bumping
+    click_count on the 40-column Product row churns the wide row (and
+    its TOASTed text) on every click. Keeping the counters here means
+    hot updates touch a narrow row and vacuum stays cheap
+    """
+    product = models.OneToOneField(Product, primary_key=True, related_name='stats')
     click_count = models.IntegerField(blank=False, null=False, default=0)
     display_score = models.IntegerField(blank=False, null=False, default=0)
+    hours_left = models.IntegerField(default=settings.SHELF_LIFE, null=True, blank=True)
+
+    @classmethod
+    def record_click(cls, product_id):
+        """Bumps click_count with a single UPDATE, no read-modify-write"""
+        updated = cls.objects.filter(pk=product_id).update(click_count=models.F('click_count') + 1)
+        if not updated:
+            # products that predate stats rows (or were loaded outside
+            # Product.save/bulk_ingest) don't have one yet
+            _, created = cls.objects.get_or_create(product_id=product_id, defaults={'click_count': 1})
+            if not created:
+                # lost the creation race to another request; count the
+                # click on the row that won
+                cls.objects.filter(pk=product_id).update(click_count=models.F('click_count') + 1)
+
+
+# DDL for the materialized view behind ProductFeed. Executed once at
+# deploy (and re-run if the shape changes); the unique index is what
+# lets REFRESH ... CONCURRENTLY work
+PRODUCT_FEED_SQL = """
+CREATE MATERIALIZED VIEW product_feed AS
+SELECT p.id,
+       p.slug,
+       p.short_name,
+       p.msrp,
+       p.retailer_id,
+       p.pub_date,
+       COALESCE(stats.display_score, 0) AS display_score
+FROM raredoor_product p
+LEFT JOIN raredoor_productstats stats ON stats.product_id = p.id
+WHERE p.is_published AND p.is_featured AND NOT p.is_sold
+ORDER BY COALESCE(stats.display_score, 0) DESC, p.pub_date DESC;
+CREATE UNIQUE INDEX product_feed_id_idx ON product_feed (id);
+"""
+
+
+class ProductFeed(models.Model):
+    """Read-only row of the homepage 'featured' feed.
+
+    Backed by the product_feed materialized view (see PRODUCT_FEED_SQL),
+    so the homepage reads a narrow precomputed table instead of
+    re-running the published/featured/unsold join on every request.
+    Kept fresh out of band with refresh()
+    """
+    id = models.UUIDField(primary_key=True)
+    slug = models.SlugField(max_length=255)
+    short_name = models.CharField(max_length=100)
+    msrp = MoneyField()
+    retailer_id = models.UUIDField(null=True)
+    pub_date = models.DateTimeField(null=True)
+    display_score = models.IntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'product_feed'
+
+    @classmethod
+    def refresh(cls, concurrently=True):
+        """Rebuilds the feed; CONCURRENTLY keeps readers unblocked"""
+        with connection.cursor() as cursor:
+            cursor.execute('REFRESH MATERIALIZED VIEW %s product_feed' % (
+                'CONCURRENTLY' if concurrently else ''))